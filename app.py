@@ -1,31 +1,178 @@
 import os
 import json
+import mimetypes
+import multiprocessing
+import importlib.util
+import re
+import shutil
+import subprocess
+import hashlib
+import tempfile
+import threading
+import zipfile
+from urllib.parse import quote
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import httpx
 from google import genai
 from pydantic import BaseModel
-from flask import Flask, request, jsonify, send_from_directory, render_template, session
+from flask.json.provider import DefaultJSONProvider
+from flask import Flask, Request, request, jsonify, send_from_directory, render_template, session
+from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 from docx import Document
+from lxml import etree
 import pypdf
 
+try:
+    import pymupdf as fitz  # PyMuPDF: C-backed parser, much faster than pypdf
+except ImportError:
+    fitz = None
+
+try:
+    import diskcache  # Persists Gemini results across restarts when installed
+except ImportError:
+    diskcache = None
+
+try:
+    import orjson  # Faster JSON encode/decode for requests, responses and sessions
+except ImportError:
+    orjson = None
+
+try:
+    import redis  # Shared session store for multi-worker deployments
+except ImportError:
+    redis = None
+
+try:
+    # Parses multipart uploads in C without Werkzeug's MultiPartParser
+    from streaming_form_data import StreamingFormDataParser
+    from streaming_form_data.targets import FileTarget
+except ImportError:
+    StreamingFormDataParser = None
+
 # --------------------------------------
 # Configuration
 # --------------------------------------
 # os.environ['GENAI_API_KEY'] = 'YOUR_API_KEY_HERE' # Set this in your environment variables
-UPLOAD_FOLDER = 'UPLOAD_FOLDER'
+# Absolute, so uploads, caches and both /download modes agree whatever the CWD
+UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'UPLOAD_FOLDER')
 ALLOWED_EXTENSIONS = {'pdf', 'docx'}
 GEMINI_API_KEY = os.environ.get("GENAI_API_KEY")
+REDIS_URL = os.environ.get("REDIS_URL")
+SESSION_TTL = 3600  # seconds
+# nginx internal location aliased to UPLOAD_FOLDER, e.g. /_protected/
+X_ACCEL_REDIRECT_PREFIX = os.environ.get("X_ACCEL_REDIRECT_PREFIX")
+GEMINI_MODEL = 'gemini-2.0-flash'
+GEMINI_INSTRUCTIONS = (
+    "Analyze the following legal document text and identify all the variable fields that need to be filled in by the user. "
+    "Ignore standard boilerplate text. Look for placeholders like [Name], {Date}, or contextually missing information."
+)
+GEMINI_HTTP2 = importlib.util.find_spec('h2') is not None  # httpx needs h2 for HTTP/2
+GEMINI_TEXT_LIMIT = 10000  # Truncate to avoid token limits for this demo
+GEMINI_SCAN_LIMIT = 20 * GEMINI_TEXT_LIMIT  # Text searched for placeholder-heavy chunks
+GEMINI_CHUNK_SIZE = 1000
+GEMINI_TOP_CHUNKS = 20
+# Bracketed/templated names, blanks to fill, and TBD markers
+PLACEHOLDER_PATTERN = re.compile(r"\[[^\]]{1,60}\]|\{\{[^}]{1,60}\}\}|_{3,}|<TBD>", re.IGNORECASE)
+GEMINI_CACHE_SIZE = 512
+GEMINI_BATCH_SIZE = 8  # Documents per Gemini call when one caller identifies several
+GEMINI_MAX_CONCURRENCY = 8  # Gemini calls in flight per process while text is extracted
+UPLOAD_CHUNK_SIZE = 64 * 1024
+TEXT_CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, '.text_cache')
+TEXT_CACHE_MAX_FILES = 256  # Least recently used entries beyond this are deleted
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+# Run children that contribute text, mirroring python-docx's Run.text. w:br is
+# handled separately: only line breaks become "\n", page/column breaks are dropped.
+DOCX_RUN_TEXT = {W_NS + 'tab': '\t', W_NS + 'ptab': '\t', W_NS + 'cr': '\n', W_NS + 'noBreakHyphen': '-'}
+DOCX_MAX_UNCOMPRESSED = 50 * 1024 * 1024  # Reject zip bombs before parsing
+DOCX_MAX_RATIO = 100  # Uncompressed / compressed size
+PDFTOTEXT = shutil.which("pdftotext")  # Poppler binary, used as the fast path when present
+PDFTOTEXT_TIMEOUT = 30  # seconds
+# Turns a character budget into a page cap. Kept low so typical pages overshoot the
+# budget and the surplus is trimmed; pages averaging less than this still come up short.
+PDFTOTEXT_MIN_CHARS_PER_PAGE = 100
+PDF_PARALLEL_MIN_PAGES = 8  # Below this, process pool overhead outweighs the gain
+# Per Gunicorn worker, so keep it small; every worker builds its own pool
+PDF_POOL_WORKERS = int(os.environ.get("PDF_POOL_WORKERS", 2))
+# Expand ligatures ("\ufb01" -> "fi") so placeholders are spelled as typed; this costs
+# MuPDF a little extra work per glyph and is not a speedup
+PDF_TEXT_FLAGS = (
+    fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_PRESERVE_LIGATURES
+    if fitz is not None else 0
+)
+
+class UploadRequest(Request):
+    """Spool multipart file parts straight into UPLOAD_FOLDER.
+
+    Werkzeug's default spools to the system temp dir, so saving the upload
+    copies it a second time. Spooling next to the destination lets the
+    upload be moved into place with a rename instead.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = tempfile.NamedTemporaryFile(dir=UPLOAD_FOLDER, suffix='.part', delete=False)
+        self.spooled_paths = getattr(self, 'spooled_paths', []) + [stream.name]
+        return stream
+
+    def close(self):
+        super().close()
+        # Remove any spooled part that was not moved into place
+        for path in getattr(self, 'spooled_paths', []):
+            if os.path.exists(path):
+                os.remove(path)
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Serve jsonify() and request.json through orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.request_class = UploadRequest
+if orjson is not None:
+    app.json = ORJSONProvider(app)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB upload limit
+app.config['USE_X_SENDFILE'] = bool(os.environ.get("USE_X_SENDFILE"))  # Apache/lighttpd
 app.secret_key = 'super_secret_key_for_demo_only' # In prod, use a real secret key
 
 client = None
 if GEMINI_API_KEY:
-    client = genai.Client(api_key=GEMINI_API_KEY)
+    # Keep warm connections to Gemini so back-to-back requests skip the TLS handshake
+    client = genai.Client(
+        api_key=GEMINI_API_KEY,
+        http_options={
+            'client_args': {
+                'http2': GEMINI_HTTP2,
+                'limits': httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+            },
+            'retry_options': {'attempts': 3, 'initial_delay': 0.5, 'max_delay': 8.0},
+        },
+    )
+
+# Guards the lazily-created shared state below; requests are served on threads.
+# Held only for in-memory bookkeeping, never across disk or network I/O.
+state_lock = threading.Lock()
+
+# Created lazily so worker processes are not forked at import time
+pdf_executor = None
+gemini_executor = None
+
+# Gemini results keyed by document hash; see get_gemini_cache()
+gemini_cache = None
 
-# In-memory storage for demo purposes (use a DB in production)
+# Sessions live in Redis when REDIS_URL is set so every worker sees them and
+# stale ones expire; otherwise fall back to in-memory storage for local demos.
 # Structure: { session_id: { 'text': ..., 'variables': [...], 'answers': {...}, 'filename': ... } }
+redis_client = None
+if REDIS_URL and redis is not None:
+    redis_client = redis.Redis.from_url(REDIS_URL)
 user_sessions = {}
 
 # --------------------------------------
@@ -48,80 +195,456 @@ def allowed_file(filename: str) -> bool:
         and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
     )
 
+def load_session(session_id):
+    """Return the stored session dict, or None if it is unknown or expired."""
+    if not session_id:
+        return None
+    if redis_client is not None:
+        raw = redis_client.get(f"sess:{session_id}")
+        return app.json.loads(raw) if raw else None
+    return user_sessions.get(session_id)
+
+def save_session(session_id, session_data):
+    if redis_client is not None:
+        redis_client.setex(f"sess:{session_id}", SESSION_TTL, app.json.dumps(session_data))
+    else:
+        user_sessions[session_id] = session_data
+
+def receive_upload():
+    """Write the multipart 'file' field to a temporary file in UPLOAD_FOLDER.
+
+    Returns (client filename, temp path). The filename is None if no file part was sent.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], suffix='.part')
+    os.close(fd)
+    try:
+        if StreamingFormDataParser is not None:
+            target = FileTarget(tmp_path)
+            parser = StreamingFormDataParser(headers=request.headers)
+            parser.register('file', target)
+            while chunk := request.stream.read(UPLOAD_CHUNK_SIZE):
+                parser.data_received(chunk)
+            return target.multipart_filename, tmp_path
+
+        file = request.files.get('file')
+        if file is None:
+            return None, tmp_path
+        # UploadRequest already spooled the part into UPLOAD_FOLDER
+        file.stream.close()
+        os.replace(file.stream.name, tmp_path)
+        return file.filename, tmp_path
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+def check_docx_size(filepath):
+    """Raise ValueError if the DOCX would expand to an unreasonable size when unzipped."""
+    with zipfile.ZipFile(filepath) as z:
+        total = sum(info.file_size for info in z.infolist())
+    if total > DOCX_MAX_UNCOMPRESSED:
+        raise ValueError("Document is too large to process")
+    if total > DOCX_MAX_RATIO * max(os.path.getsize(filepath), 1):
+        raise ValueError("Document is too highly compressed to process")
+
 def extract_text_from_docx(filepath):
-    doc = Document(filepath)
+    check_docx_size(filepath)
+    # Stream word/document.xml rather than building python-docx's object model.
+    # Like Document.paragraphs, only top-level body paragraphs are read.
     full_text = []
-    for para in doc.paragraphs:
-        full_text.append(para.text)
+    with zipfile.ZipFile(filepath) as z, z.open('word/document.xml') as f:
+        events = etree.iterparse(
+            f,
+            tag=(W_NS + 'p', W_NS + 'tbl'),
+            resolve_entities=False,
+            no_network=True,
+            huge_tree=False,
+        )
+        for _, elem in events:
+            parent = elem.getparent()
+            if parent is None or parent.tag != W_NS + 'body':
+                continue
+            if elem.tag == W_NS + 'p':
+                parts = []
+                for child in elem.xpath('./w:r/* | ./w:hyperlink/w:r/*', namespaces={'w': W_NS[1:-1]}):
+                    if child.tag == W_NS + 't':
+                        parts.append(child.text or '')
+                    elif child.tag == W_NS + 'br':
+                        if child.get(W_NS + 'type', 'textWrapping') == 'textWrapping':
+                            parts.append('\n')
+                    elif child.tag in DOCX_RUN_TEXT:
+                        parts.append(DOCX_RUN_TEXT[child.tag])
+                full_text.append(''.join(parts))
+            # Free processed body content so memory stays flat on large documents
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
     return '\n'.join(full_text)
 
-def extract_text_from_pdf(filepath):
-    text = ""
+def get_pdf_executor():
+    global pdf_executor
+    with state_lock:
+        if pdf_executor is None:
+            # Request and httpx threads are already running here, so don't fork:
+            # forkserver children start from a clean single-threaded process
+            pdf_executor = ProcessPoolExecutor(
+                max_workers=PDF_POOL_WORKERS,
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+        return pdf_executor
+
+def discard_pdf_executor(executor):
+    global pdf_executor
+    with state_lock:
+        if pdf_executor is executor:
+            pdf_executor = None
+    executor.shutdown(wait=False)
+
+def get_gemini_executor():
+    global gemini_executor
+    with state_lock:
+        if gemini_executor is None:
+            gemini_executor = ThreadPoolExecutor(max_workers=GEMINI_MAX_CONCURRENCY)
+        return gemini_executor
+
+def extract_pdf_page_range(filepath, start, stop):
+    # Runs in a worker process, so it opens its own handle on the file
+    with fitz.open(filepath) as doc:
+        return [doc.load_page(i).get_text("text", flags=PDF_TEXT_FLAGS) for i in range(start, stop)]
+
+def join_pages(page_texts, max_chars=None):
+    """Join page texts, stopping early once max_chars have been collected.
+
+    Returns (text, complete); complete is False if the budget stopped the walk.
+    """
+    parts = []
+    total = 0
+    for text in page_texts:
+        parts.append(text)
+        total += len(text) + 1
+        if max_chars is not None and total >= max_chars:
+            return '\n'.join(parts), False
+    return '\n'.join(parts), True
+
+def extract_text_with_pdftotext(filepath, max_chars=None):
+    args = [PDFTOTEXT, '-enc', 'UTF-8']
+    if max_chars is not None:
+        page_cap = -(-max_chars // PDFTOTEXT_MIN_CHARS_PER_PAGE)
+        args += ['-l', str(page_cap)]
+    result = subprocess.run(
+        args + [filepath, '-'],
+        capture_output=True,
+        timeout=PDFTOTEXT_TIMEOUT,
+        check=True,
+    )
+    # Pages end with a form feed; split on it so the budget is trimmed per page like MuPDF's
+    output = result.stdout.decode('utf-8', 'replace')
+    text, complete = join_pages(output.rstrip('\f').split('\f'), max_chars)
+    # Stopping at the -l cap means later pages were never read
+    if max_chars is not None and output.count('\f') >= page_cap:
+        complete = False
+    return text, complete
+
+def extract_text_from_pdf(filepath, max_chars=None):
+    """Return (text, complete) for a PDF, reading roughly max_chars characters at most."""
+    if PDFTOTEXT:
+        try:
+            return extract_text_with_pdftotext(filepath, max_chars)
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"pdftotext Error: {e}")
+
+    if fitz is not None:
+        with fitz.open(filepath) as doc:
+            page_count = doc.page_count
+            # A bounded extraction usually needs only the first few pages,
+            # so walk them lazily rather than parsing the whole file in the pool
+            if max_chars is not None or page_count < PDF_PARALLEL_MIN_PAGES:
+                return join_pages((page.get_text("text", flags=PDF_TEXT_FLAGS) for page in doc), max_chars)
+
+        # Fan contiguous page ranges out over the pool; map() keeps page order
+        step = -(-page_count // PDF_POOL_WORKERS)
+        starts = list(range(0, page_count, step))
+        stops = [min(start + step, page_count) for start in starts]
+        executor = get_pdf_executor()
+        try:
+            results = executor.map(
+                extract_pdf_page_range, [filepath] * len(starts), starts, stops
+            )
+            return '\n'.join(text for chunk in results for text in chunk), True
+        except BrokenProcessPool as e:
+            # A child died (e.g. MuPDF crashed on this file, or the OOM killer);
+            # drop the pool so the next PDF gets a fresh one, and parse here
+            print(f"PDF Pool Error: {e}")
+            discard_pdf_executor(executor)
+        with fitz.open(filepath) as doc:
+            return join_pages(page.get_text("text", flags=PDF_TEXT_FLAGS) for page in doc)
+
+    # Fallback for deployments without the PyMuPDF wheel
     with open(filepath, 'rb') as file:
         reader = pypdf.PdfReader(file)
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
-    return text
+        # Pages without a content stream have no text to extract
+        return join_pages(
+            (page.extract_text() or "" for page in reader.pages if '/Contents' in page),
+            max_chars,
+        )
 
-def identify_variables_with_gemini(text):
-    if not client:
-        print("DEBUG: Using mock data because client is not initialized.")
-        # Mock response if no API key or client not initialized
-        return [
-            {"name": "Client Name", "description": "The full name of the client"},
-            {"name": "Date", "description": "The date of the agreement"},
-            {"name": "Amount", "description": "The total amount in USD"}
-        ]
-    
-    prompt = f"""
-    Analyze the following legal document text and identify all the variable fields that need to be filled in by the user.
-    Ignore standard boilerplate text. Look for placeholders like [Name], {{Date}}, or contextually missing information.
-    
-    Document Text:
-    {text[:10000]} # Truncate to avoid token limits for this demo
-    """
-    
+def hash_file(filepath):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_cached_text(cache_name):
     try:
-        response = client.models.generate_content(
-            model='gemini-2.0-flash',
-            contents=prompt,
-            config={
-                'response_mime_type': 'application/json',
-                'response_schema': VariableList,
-            },
+        with open(os.path.join(TEXT_CACHE_FOLDER, f"{cache_name}.txt"), encoding='utf-8') as f:
+            # Bump the mtime so prune_text_cache() treats this entry as recently used;
+            # touching the open fd cannot race with another worker's prune
+            os.utime(f.fileno())
+            return f.read()
+    except FileNotFoundError:
+        return None  # Not cached yet, or pruned by another worker
+
+def extract_text(filepath, file_hash=None, max_chars=None):
+    """Extract document text, memoized on disk by file hash when one is given.
+
+    PDF extraction stops after roughly max_chars characters; DOCX is always read in full.
+    Returns (text, complete), where complete is False if max_chars cut the text short.
+    """
+    if not filepath.endswith('.pdf'):
+        max_chars = None
+    if file_hash:
+        if max_chars is not None:
+            text = read_cached_text(f"{file_hash}-{max_chars}")
+            if text is not None:
+                return text, False
+        text = read_cached_text(file_hash)
+        # A full text within the budget is exactly what the bounded pass would return
+        if text is not None and (max_chars is None or len(text) < max_chars):
+            return text, True
+
+    if filepath.endswith('.pdf'):
+        text, complete = extract_text_from_pdf(filepath, max_chars)
+    else:
+        text, complete = extract_text_from_docx(filepath), True
+
+    if file_hash:
+        # Text that fit within the budget is the whole document, so cache it as such
+        cache_name = file_hash if complete else f"{file_hash}-{max_chars}"
+        cache_path = os.path.join(TEXT_CACHE_FOLDER, f"{cache_name}.txt")
+        os.makedirs(TEXT_CACHE_FOLDER, exist_ok=True)
+        # Write then rename so concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=TEXT_CACHE_FOLDER, suffix='.part')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, cache_path)
+        prune_text_cache()
+    return text, complete
+
+def prune_text_cache():
+    """Delete the least recently used text cache files beyond TEXT_CACHE_MAX_FILES."""
+    entries = []
+    for entry in os.scandir(TEXT_CACHE_FOLDER):
+        if entry.name.endswith('.txt'):
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                continue  # Pruned concurrently by another worker
+    entries.sort()
+    for _, path in entries[:-TEXT_CACHE_MAX_FILES]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def get_gemini_cache():
+    global gemini_cache
+    if gemini_cache is not None:
+        return gemini_cache
+    # Opening diskcache touches SQLite, so do it before taking the lock
+    if diskcache is not None:
+        cache = diskcache.Cache(os.path.join(UPLOAD_FOLDER, '.gemini_cache'))
+    else:
+        cache = OrderedDict()
+    with state_lock:
+        if gemini_cache is None:
+            gemini_cache = cache
+        elif diskcache is not None:
+            cache.close()
+        return gemini_cache
+
+def get_cached_variables(key):
+    cache = get_gemini_cache()
+    if not isinstance(cache, OrderedDict):
+        return cache.get(key)  # diskcache is thread-safe on its own
+    with state_lock:
+        cached = cache.get(key)
+        if cached is not None:
+            cache.move_to_end(key)
+        return cached
+
+def cache_variables(key, variables):
+    cache = get_gemini_cache()
+    if not isinstance(cache, OrderedDict):
+        cache[key] = variables
+        return
+    with state_lock:
+        cache[key] = variables
+        if len(cache) > GEMINI_CACHE_SIZE:
+            cache.popitem(last=False)
+
+def document_hash(text):
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+def select_gemini_text(text):
+    """Pick the chunks of text most likely to contain placeholders, within GEMINI_TEXT_LIMIT.
+
+    Falls back to the leading text when no placeholder markers are found.
+    """
+    # Pack lines into roughly GEMINI_CHUNK_SIZE chunks; PDF and DOCX text both break on lines
+    chunks = []
+    current = []
+    size = 0
+    for line in text.split('\n'):
+        current.append(line)
+        size += len(line) + 1
+        if size >= GEMINI_CHUNK_SIZE:
+            chunks.append('\n'.join(current))
+            current = []
+            size = 0
+    if current:
+        chunks.append('\n'.join(current))
+
+    scores = [len(PLACEHOLDER_PATTERN.findall(chunk)) for chunk in chunks]
+    ranked = sorted(range(len(chunks)), key=lambda i: (-scores[i], i))
+    picked = []
+    total = 0
+    for i in ranked[:GEMINI_TOP_CHUNKS]:
+        if scores[i] == 0:
+            break
+        if total + len(chunks[i]) > GEMINI_TEXT_LIMIT:
+            continue
+        picked.append(i)
+        total += len(chunks[i]) + 2
+    if not picked:
+        return text[:GEMINI_TEXT_LIMIT]
+
+    # Keep the selected chunks in document order so Gemini sees them in context
+    return '\n\n'.join(chunks[i] for i in sorted(picked))
+
+def lookup_variables(text):
+    """Return (prompt text, cache key, cached variables or None) for a document."""
+    prompt_text = select_gemini_text(text)
+    key = document_hash(prompt_text)
+    return prompt_text, key, get_cached_variables(key)
+
+def request_variables(prompt_texts):
+    """Ask Gemini about one or more documents in a single call; raises on any failure."""
+    config = {
+        'response_mime_type': 'application/json',
+        'response_schema': VariableList if len(prompt_texts) == 1 else list[VariableList],
+        'system_instruction': GEMINI_INSTRUCTIONS,
+    }
+
+    if len(prompt_texts) == 1:
+        contents = prompt_texts[0]
+    else:
+        # Break up marker look-alikes in the text so a document can't forge a boundary
+        contents = (
+            f"The following {len(prompt_texts)} documents are separated by ===DOC n=== markers. "
+            "Return one variable list per document, in the same order.\n\n"
+            + ''.join(
+                f"===DOC {n}===\n\n{text.replace('===DOC', '= = =DOC')}\n\n"
+                for n, text in enumerate(prompt_texts, 1)
+            )
         )
-        # response.parsed is already a VariableList instance
-        return [v.model_dump() for v in response.parsed.variables]
+
+    response = client.models.generate_content(
+        model=GEMINI_MODEL,
+        contents=contents,
+        config=config,
+    )
+    # response.parsed is already a VariableList instance (or a list of them)
+    parsed = [response.parsed] if len(prompt_texts) == 1 else response.parsed
+    if len(parsed) != len(prompt_texts):
+        raise ValueError(f"expected {len(prompt_texts)} variable lists, got {len(parsed)}")
+    return [[v.model_dump() for v in variable_list.variables] for variable_list in parsed]
+
+def fetch_variables(prompt_texts, keys):
+    """Return one variable list per document, caching each successful result.
+
+    If a batched call fails, each document is retried on its own before falling back to [].
+    """
+    try:
+        results = request_variables(prompt_texts)
     except Exception as e:
         print(f"Gemini Error: {e}")
-        return []
+        if len(prompt_texts) == 1:
+            return [[]]
+        return [fetch_variables([text], [key])[0] for text, key in zip(prompt_texts, keys)]
+
+    for key, variables in zip(keys, results):
+        cache_variables(key, variables)
+    return results
+
+def mock_variables():
+    print("DEBUG: Using mock data because client is not initialized.")
+    # Mock response if no API key or client not initialized
+    return [
+        {"name": "Client Name", "description": "The full name of the client"},
+        {"name": "Date", "description": "The date of the agreement"},
+        {"name": "Amount", "description": "The total amount in USD"}
+    ]
+
+def identify_variables(texts):
+    """Return one variable list per document text.
+
+    Only the documents passed in share a prompt, so different users' contracts are
+    never batched together. Cache misses go to Gemini in groups of GEMINI_BATCH_SIZE
+    that run in parallel.
+    """
+    if not client:
+        return [mock_variables() for _ in texts]
+
+    lookups = [lookup_variables(text) for text in texts]
+    found = {key: cached for _, key, cached in lookups if cached is not None}
+    # Identical documents share a cache key; ask Gemini about each one only once
+    missing = {key: prompt_text for prompt_text, key, cached in lookups if cached is None}
+
+    keys = list(missing)
+    groups = [keys[start:start + GEMINI_BATCH_SIZE] for start in range(0, len(keys), GEMINI_BATCH_SIZE)]
+    # The first group runs on this thread, so a single-group call never waits on
+    # the executor it may itself be running in
+    futures = [
+        get_gemini_executor().submit(fetch_variables, [missing[key] for key in group], group)
+        for group in groups[1:]
+    ]
+    for group in groups[:1]:
+        found.update(zip(group, fetch_variables([missing[key] for key in group], group)))
+    for group, future in zip(groups[1:], futures):
+        found.update(zip(group, future.result()))
+    return [found[key] for _, key, _ in lookups]
 
 def replace_variables_in_docx(filepath, answers, output_path):
+    check_docx_size(filepath)
     doc = Document(filepath)
     # Simple replacement in paragraphs
     # Note: This is a basic implementation. Complex docx structures (tables, headers) might need more work.
-    for para in doc.paragraphs:
-        for key, value in answers.items():
-            # This is a naive replacement. Real-world docx replacement is complex due to runs.
-            # For this demo, we'll assume simple text matching or placeholders.
-            # Since we don't know the exact placeholder format from Gemini, we might need a smarter way.
-            # For now, let's assume we append the values at the end or try to find the "name" if it exists.
-            # BETTER APPROACH for this demo: Just append a summary of filled variables at the end
-            # because exact in-place replacement requires knowing the EXACT placeholder string used in the doc.
-            pass
-            
-    # For the sake of the demo "filling placeholders", we will create a new document 
-    # that lists the filled terms, or try to replace if we can guess the placeholder.
-    # Let's try to replace standard bracketed placeholders if they match the variable name.
-    
-    for para in doc.paragraphs:
-        for key, value in answers.items():
-            if key in para.text:
-                para.text = para.text.replace(key, value)
-            # Also try brackets
-            if f"[{key}]" in para.text:
-                para.text = para.text.replace(f"[{key}]", value)
-                
+    # Since we don't know the exact placeholder format from Gemini, we replace both the
+    # bare variable name and its bracketed form, e.g. "Client Name" and "[Client Name]".
+    lookup = {}
+    for key, value in (answers or {}).items():
+        if key:
+            lookup[key] = value
+            lookup[f"[{key}]"] = value
+
+    if lookup:
+        # One alternation of every placeholder, longest first so "Company Name" wins over "Name"
+        pattern = re.compile('|'.join(re.escape(k) for k in sorted(lookup, key=len, reverse=True)))
+
+        for para in doc.paragraphs:
+            if pattern.search(para.text):
+                para.text = pattern.sub(lambda m: lookup[m.group(0)], para.text)
+
     doc.save(output_path)
 
 # --------------------------------------
@@ -136,29 +659,36 @@ def index():
 @app.route('/upload', methods=['POST'])
 def upload_file():
     """Handle file upload."""
-    if 'file' not in request.files:
-        return jsonify({"status": "error", "message": "No file part"}), 400
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    try:
+        client_filename, tmp_path = receive_upload()
+    except HTTPException:
+        raise
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
 
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({"status": "error", "message": "No file selected"}), 400
+    try:
+        if client_filename is None:
+            return jsonify({"status": "error", "message": "No file part"}), 400
 
-    if not allowed_file(file.filename):
-        return jsonify({"status": "error", "message": "Invalid file type"}), 400
+        if client_filename == '':
+            return jsonify({"status": "error", "message": "No file selected"}), 400
 
-    try:
-        filename = secure_filename(file.filename)
+        if not allowed_file(client_filename):
+            return jsonify({"status": "error", "message": "Invalid file type"}), 400
+
+        filename = secure_filename(client_filename)
         save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-        file.save(save_path)
+        os.replace(tmp_path, save_path)
         
         # Initialize session
         session_id = os.urandom(16).hex()
-        user_sessions[session_id] = {
+        save_session(session_id, {
             'filename': filename,
             'filepath': save_path,
+            'file_hash': hash_file(save_path),
             'answers': {}
-        }
+        })
         
         return jsonify({
             "status": "success",
@@ -169,30 +699,38 @@ def upload_file():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+    finally:
+        # Rejected or failed uploads leave the temp file behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
 
 @app.route('/analyze', methods=['POST'])
 def analyze_document():
     data = request.json
     session_id = data.get('session_id')
     
-    if not session_id or session_id not in user_sessions:
-        return jsonify({"status": "error", "message": "Invalid session"}), 400
-        
-    session_data = user_sessions[session_id]
-    filepath = session_data['filepath']
-    
-    # Extract text
     try:
-        if filepath.endswith('.pdf'):
-            text = extract_text_from_pdf(filepath)
-        else:
-            text = extract_text_from_docx(filepath)
+        # Inside the try so a session store outage is reported as JSON too
+        session_data = load_session(session_id)
+        if session_data is None:
+            return jsonify({"status": "error", "message": "Invalid session"}), 400
             
-        session_data['text'] = text
+        filepath = session_data['filepath']
+        
+        # Extract text
+        # Gemini's input is chosen from the first GEMINI_SCAN_LIMIT characters, so start
+        # it on those and extract the full text for the session while it responds
+        file_hash = session_data.get('file_hash')
+        head, complete = extract_text(filepath, file_hash, GEMINI_SCAN_LIMIT)
+        variables_future = get_gemini_executor().submit(identify_variables, [head])
+        # Most documents fit within the scan limit, so only re-read those that didn't
+        session_data['text'] = head if complete else extract_text(filepath, file_hash)[0]
         
         # Identify variables
-        variables = identify_variables_with_gemini(text)
+        variables = variables_future.result()[0]
         session_data['variables'] = variables
+        save_session(session_id, session_data)
         
         return jsonify({
             "status": "success",
@@ -209,18 +747,18 @@ def generate_document():
     session_id = data.get('session_id')
     answers = data.get('answers') # { "Variable Name": "Value" }
     
-    if not session_id or session_id not in user_sessions:
-        return jsonify({"status": "error", "message": "Invalid session"}), 400
-        
-    session_data = user_sessions[session_id]
-    original_path = session_data['filepath']
-    
-    # Create output filename
-    filename_base = os.path.splitext(session_data['filename'])[0]
-    output_filename = f"{filename_base}_filled.docx"
-    output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
-    
     try:
+        session_data = load_session(session_id)
+        if session_data is None:
+            return jsonify({"status": "error", "message": "Invalid session"}), 400
+            
+        original_path = session_data['filepath']
+        
+        # Create output filename
+        filename_base = os.path.splitext(session_data['filename'])[0]
+        output_filename = f"{filename_base}_filled.docx"
+        output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
+        
         # For PDF we can't easily edit, so we'll just create a summary DOCX for now
         # Or if it was a DOCX, we try to replace.
         if original_path.endswith('.docx'):
@@ -246,6 +784,19 @@ def generate_document():
 def download_file(filename):
     """Serve file securely to client."""
     try:
+        if X_ACCEL_REDIRECT_PREFIX:
+            # Hand the transfer to nginx, which sendfile()s it from the internal location
+            path = safe_join(app.config['UPLOAD_FOLDER'], filename)
+            if path is None or not os.path.isfile(path):
+                raise NotFound()
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            response = app.response_class(mimetype=mimetype)
+            response.headers['X-Accel-Redirect'] = f"{X_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{quote(filename)}"
+            response.headers.set('Content-Disposition', 'attachment', filename=filename)
+            return response
+
+        # Otherwise send_from_directory emits X-Sendfile when USE_X_SENDFILE is set,
+        # or returns a file wrapper that Gunicorn serves with sendfile()
         return send_from_directory(
             app.config['UPLOAD_FOLDER'],
             filename,
@@ -256,4 +807,5 @@ def download_file(filename):
 
 
 if __name__ == "__main__":
-    app.run(debug=True, port=5001)
+    # Development server only; production runs under Gunicorn (see gunicorn.conf.py)
+    app.run(debug=bool(os.environ.get("FLASK_DEV")), port=5001)
@@ -0,0 +1,22 @@
+import os
+
+# --------------------------------------
+# Gunicorn configuration (loaded automatically from the working directory)
+# --------------------------------------
+bind = f"0.0.0.0:{os.environ.get('PORT', '5001')}"
+if os.environ.get('REDIS_URL'):
+    # Sessions are shared through Redis, so any worker can serve any request.
+    # Not derived from cpu_count(), which reports the host's CPUs in containers.
+    workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+else:
+    # Without Redis, sessions live in one process's memory; a second worker
+    # would answer /analyze for an upload it never saw with "Invalid session".
+    workers = 1
+# Threads let a worker keep serving while other requests wait on Gemini
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = 60
+# Import app.py (PyMuPDF, python-docx, google-genai) once in the master and
+# share it copy-on-write with the workers. Anything holding file descriptors
+# or threads (process pool, caches, sockets) is created lazily per worker.
+preload_app = True